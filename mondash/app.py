@@ -1,41 +1,47 @@
 #!/usr/bin/env python3
 
 import asyncio
-from collections import defaultdict
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from decimal import Decimal
 from functools import wraps
-from itertools import chain
+from heapq import merge
+from itertools import groupby
 import logging
 import os
 import sys
 from urllib.parse import urlencode
 
-from aiohttp import web
+from aiohttp import web, ClientSession, DummyCookieJar, TCPConnector
 import aiohttp_jinja2 as aiojinja
 import aiohttp_session as aiosession
 import jinja2
 
-from .utils import rand_str, currency, date_format, url, MonzoAPI, session
+from .utils import (rand_str, pack_onto, unpack, currency, date_format, month_of, url,
+                    MonzoAPI, session)
 
 
 AUTH_HOST = "https://auth.monzo.com"
 
+# Most recently used tokens to remember user IDs for; evicted ones just cost a whoami call.
+TOKEN_USERS_SIZE = 1024
 
-log = logging.getLogger(__name__)
 
-cache = {}
+log = logging.getLogger(__name__)
 
 
 def start_auth(request, sess):
     sess["state"] = rand_str()
-    callback_url = request.app.router.named_resources()["callback"].url_for()
-    data = {"client_id": request.app["client_id"],
-            "redirect_uri": "{}{}".format(request.app["client_host"], callback_url),
-            "response_type": "code",
-            "state": sess["state"]}
+    data = dict(request.app["auth_params"], state=sess["state"])
     return web.HTTPFound("{}/?{}".format(AUTH_HOST, urlencode(data)))
 
+def remember_user(app, token, user):
+    token_users = app["token_users"]
+    token_users[token] = user
+    token_users.move_to_end(token)
+    while len(token_users) > TOKEN_USERS_SIZE:
+        token_users.popitem(last=False)
+
 def auth_redir(fn):
     @wraps(fn)
     @session
@@ -49,7 +55,11 @@ def auth_redir(fn):
             return start_auth(request, sess)
         else:
             try:
-                return await fn(request, sess, MonzoAPI(token))
+                # Only trust user IDs learnt server-side, as the session cookie is client-editable.
+                user = request.app["token_users"].get(token)
+                api = MonzoAPI(token, user, session=request.app["http"])
+                remember_user(request.app, token, user or await api.user())
+                return await fn(request, sess, api)
             except MonzoAPI.NotAuthorisedError:
                 return start_auth(request, sess)
     return auth_redir_wrap
@@ -61,16 +71,17 @@ async def callback(request, sess):
     state = request.query["state"]
     if not state == sess["state"]:
         raise web.HTTPBadRequest
-    async with MonzoAPI() as api:
+    async with MonzoAPI(session=request.app["http"]) as api:
         try:
             data = await api.auth(request.app["client_id"],
                                   request.app["client_secret"],
-                                  "{}/callback".format(request.app["client_host"]),
+                                  request.app["auth_params"]["redirect_uri"],
                                   code)
         except MonzoAPI.NotAuthorisedError:
             return start_auth(request, sess)
         else:
             sess["token"] = data["access_token"]
+            remember_user(request.app, data["access_token"], data["user_id"])
             sess["expires"] = datetime.now().timestamp() + data["expires_in"]
             return web.HTTPFound("/")
 
@@ -78,86 +89,133 @@ async def callback(request, sess):
 @auth_redir
 async def clear(request, sess, api):
     user = await api.user()
-    if user in cache:
-        del cache[user]
+    request.app["cache"].pop(user, None)
     return web.HTTPFound("/")
 
 @auth_redir
 async def logout(request, sess, api):
     user = await api.user()
-    if user in cache:
-        del cache[user]
+    request.app["cache"].pop(user, None)
+    request.app["token_users"].pop(sess["token"], None)
     del sess["token"]
     return web.HTTPFound("/")
 
 
+def summarise(items):
+    """
+    Aggregate transactions into monthly totals, and flag likely duplicates.
+
+    Items must be sorted by creation time, so that each month is a contiguous run.
+    """
+    inbounds = {}
+    outbounds = {}
+    categories = {}
+    merchants = {}
+    matches = {}
+    dupes = set()
+    for month, month_items in groupby(items, key=lambda item: month_of(item["created"])):
+        inbound = outbound = 0
+        month_categories = {}
+        month_merchants = {}
+        for item in month_items:
+            if item["amount"] == 0 or item.get("decline_reason"):
+                continue
+            merchant = item["_merchant"]
+            amount = item["amount"]
+            if amount > 0:
+                inbound += amount
+            else:
+                outbound += amount
+            # A refund cancels out an earlier charge of the same amount at the same merchant.
+            match = matches.pop((merchant, -amount), None)
+            if match:
+                dupes.add(item["id"])
+                dupes.add(match)
+            else:
+                matches[(merchant, amount)] = item["id"]
+            if not merchant:
+                if item["is_load"]:
+                    merchant = "Top-up"
+                elif item["metadata"] and "pot_id" in item["metadata"]:
+                    merchant = "Pots"
+            category = item["category"]
+            month_categories[category] = month_categories.get(category, 0) + amount
+            merchant = merchant or ""
+            month_merchants[merchant] = month_merchants.get(merchant, 0) + amount
+        if inbound:
+            inbounds[month] = inbound
+        if outbound:
+            outbounds[month] = outbound
+        if month_categories:
+            categories[month] = month_categories
+            merchants[month] = month_merchants
+    return {"inbounds": inbounds,
+            "outbounds": outbounds,
+            "categories": categories,
+            "merchants": merchants,
+            "dupes": dupes}
+
+
 @aiojinja.template("base.j2")
 @auth_redir
 async def base(request, sess, api):
     async with api:
         user = await api.user()
+        cache = request.app["cache"]
         if user in cache:
             accounts = cache[user]["accounts"]
             pots = cache[user]["pots"]
+            default = cache[user]["default"]
+            packed = cache[user]["items"]
+            latest = cache[user]["latest"]
         else:
             accounts, pots = await asyncio.gather(api.accounts(), api.pots())
+            default = next(account for account in accounts if not account["closed"])
+            packed = {}
+            latest = {}
         account_ids = [account["id"] for account in accounts]
-        default = next(account for account in accounts if not account["closed"])
-        balance_data = await asyncio.gather(*(api.balance(id) for id in account_ids))
+        # Balances and transactions are independent, so fetch all of them at once.
+        # Each account resumes from its own most recent transaction.  Cached items are
+        # kept as compressed chunks, decoded off the event loop whilst the API calls run.
+        loop = asyncio.get_event_loop()
+        balance_data, item_data, account_items = await asyncio.gather(
+            asyncio.gather(*(api.balance(id) for id in account_ids)),
+            asyncio.gather(*(api.transactions(id, latest.get(id)) for id in account_ids)),
+            asyncio.gather(*(loop.run_in_executor(None, unpack, packed.get(id, ()))
+                             for id in account_ids)))
         balances = dict(zip(account_ids, balance_data))
-        items = []
-        since = None
-        if user in cache:
-            items = cache[user]["items"]
-            since = items[-1]["created"]
-        item_data = await asyncio.gather(*(api.transactions(id, since) for id in account_ids))
-        items += list(chain(*item_data))
-        items.sort(key=lambda item: item["created"])
+        for id, old_items, new_items in zip(account_ids, account_items, item_data):
+            # Skip anything a concurrent render for the same user has already stored.
+            new_items = [item for item in new_items if item["created"] > latest.get(id, "")]
+            if new_items:
+                latest[id] = max(item["created"] for item in new_items)
+                # Existing full chunks are left alone; only the partial tail gets repacked.
+                pack_onto(packed.setdefault(id, []), new_items)
+                old_items += new_items
+        # Each account's items are already in date order.
+        items = list(merge(*account_items, key=lambda item: item["created"]))
         cache[user] = {"accounts": accounts,
                        "pots": pots,
-                       "items": items}
-    inbounds = defaultdict(int)
-    outbounds = defaultdict(int)
-    categories = defaultdict(lambda: defaultdict(int))
-    merchants = defaultdict(lambda: defaultdict(int))
-    matches = {}
-    dupes = set()
-    for item in items:
-        if item["amount"] == 0 or item.get("decline_reason"):
-            continue
-        month = date_format(item["created"], "%Y-%m")
-        merchant = None
-        if item["merchant"]:
-            merchant = item["merchant"]["name"]
-        elif item["counterparty"]:
-            merchant = item["counterparty"]["name"]
-        amount = item["amount"]
-        if amount > 0:
-            inbounds[month] += amount
-        else:
-            outbounds[month] += amount
-        if (merchant, -amount) in matches:
-            dupes.add(item["id"])
-            dupes.add(matches.pop((merchant, -amount)))
-        else:
-            matches[(merchant, amount)] = item["id"]
-        if not merchant:
-            if item["is_load"]:
-                merchant = "Top-up"
-            elif item["metadata"] and "pot_id" in item["metadata"]:
-                merchant = "Pots"
-        categories[month][item["category"]] += amount
-        merchants[month][merchant or ""] += amount
+                       "default": default,
+                       "items": packed,
+                       "latest": latest}
+    summary = summarise(items)
     return {"accounts": accounts,
             "default": default,
             "pots": pots,
             "balances": balances,
             "items": items,
-            "inbounds": inbounds,
-            "outbounds": outbounds,
-            "categories": categories,
-            "merchants": merchants,
-            "dupes": dupes}
+            **summary}
+
+
+async def open_http(app):
+    # Monzo uses bearer auth, so there's no need to track cookies.
+    connector = TCPConnector(limit=50, limit_per_host=8, ttl_dns_cache=600,
+                             keepalive_timeout=60, enable_cleanup_closed=True)
+    app["http"] = ClientSession(connector=connector, cookie_jar=DummyCookieJar())
+
+async def close_http(app):
+    await app["http"].close()
 
 
 def init_app(args=()):
@@ -166,19 +224,28 @@ def init_app(args=()):
     app["client_id"] = os.getenv("CLIENT_ID")
     app["client_secret"] = os.getenv("CLIENT_SECRET")
     app["client_host"] = os.getenv("CLIENT_HOST")
+    app["cache"] = {}
+    app["token_users"] = OrderedDict()
     env = aiojinja.setup(app, loader=jinja2.FileSystemLoader(
         os.path.join(os.path.dirname(__file__), "templates")))
     env.globals.update({
         "currency": currency,
         "date_format": date_format,
+        "month_of": month_of,
         "url": url,
     })
     aiosession.setup(app, storage=aiosession.SimpleCookieStorage())  # TODO
+    app.on_startup.append(open_http)
+    app.on_cleanup.append(close_http)
     app.router.add_get("/callback", callback, name="callback")
     app.router.add_get("/clear", clear)
     app.router.add_get("/logout", logout)
     app.router.add_get("/", base)
     app.router.add_static("/static", os.path.join(os.path.dirname(__file__), "static"))
+    callback_url = app.router.named_resources()["callback"].url_for()
+    app["auth_params"] = {"client_id": app["client_id"],
+                          "redirect_uri": "{}{}".format(app["client_host"], callback_url),
+                          "response_type": "code"}
     return app
 
 
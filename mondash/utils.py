@@ -1,14 +1,18 @@
 from datetime import datetime
-from decimal import Decimal
-from functools import wraps
+from functools import lru_cache, wraps
 import logging
-from random import choices
-import string
+from secrets import token_urlsafe
 from urllib.parse import urlparse, urlunparse
+import zlib
 
 from aiohttp import ClientSession, ClientResponseError
 import aiohttp_session as aiosession
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
 
 API_HOST = "https://api.monzo.com"
 
@@ -17,21 +21,57 @@ log = logging.getLogger(__name__)
 
 
 def rand_str():
-    return "".join(choices(string.ascii_uppercase + string.digits, k=32))
+    return token_urlsafe(24)
+
+
+PACK_SIZE = 1000
+
+
+def pack(data, size=PACK_SIZE):
+    # Bounded chunks keep each decode step short, so unpack() in a thread doesn't hog the GIL.
+    blobs = []
+    for i in range(0, len(data), size):
+        blob = json_dumps(data[i:i + size])
+        if isinstance(blob, str):
+            blob = blob.encode("utf-8")
+        blobs.append(zlib.compress(blob, 1))
+    return blobs
+
+def pack_onto(blobs, data, size=PACK_SIZE):
+    # Only the last chunk may be partial: fold it in with the new data, so small appends
+    # don't leave behind a trail of tiny, poorly compressed chunks.
+    if blobs:
+        tail = unpack(blobs[-1:])
+        if len(tail) < size:
+            blobs.pop()
+            data = tail + data
+    blobs.extend(pack(data, size))
+
+def unpack(blobs):
+    return [item for blob in blobs for item in json_loads(zlib.decompress(blob))]
 
 
 def currency(amount, decimal=True):
     if amount % 100 == 0 and not decimal:
         return str(amount / 100)
     else:
-        return "{:.2f}".format(Decimal(amount) / 100)
+        pounds, pence = divmod(abs(amount), 100)
+        return "{}{}.{:02d}".format("-" if amount < 0 else "", pounds, pence)
 
-def date_format(timestamp, format):
+@lru_cache(maxsize=4096)
+def parse_date(timestamp):
+    # Most API timestamps carry fractional seconds, so try that format first.
     try:
-        date = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
     except ValueError:
-        date = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    return date.strftime(format)
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+
+def date_format(timestamp, format):
+    return parse_date(timestamp).strftime(format)
+
+def month_of(timestamp):
+    # Equivalent to date_format(timestamp, "%Y-%m") for ISO 8601 timestamps.
+    return timestamp[:7]
 
 def url(text, display=False):
     parsed = urlparse(text)
@@ -59,6 +99,14 @@ class MonzoAPI:
 
         >>> api = MonzoAPI(token)
 
+    Skipping the whoami lookup if the user ID is already known::
+
+        >>> api = MonzoAPI(token, "user_xyz")
+
+    Borrowing a long-lived session (``with api`` leaves it open)::
+
+        >>> api = MonzoAPI(token, session=app["http"])
+
     Using a new OAuth code::
 
         >>> api = MonzoAPI()
@@ -77,10 +125,11 @@ class MonzoAPI:
 
     class NotAuthorisedError(Exception): pass
 
-    def __init__(self, token=None):
+    def __init__(self, token=None, user=None, session=None):
         self._token = token
-        self._user = None
-        self._sess = ClientSession()
+        self._user = user
+        self._owner = session is None
+        self._sess = session or ClientSession()
 
     async def __call__(self, method, path, key=None, **kwargs):
         log.debug("API call: {} {}".format(method, path))
@@ -95,16 +144,17 @@ class MonzoAPI:
                 if e.code == 401:
                     raise MonzoAPI.NotAuthorisedError
                 raise
-            data = await resp.json()
+            data = await resp.json(loads=json_loads)
             return data[key] if key else data
 
     async def __aenter__(self):
-        await self._sess.__aenter__()
+        if self._owner:
+            await self._sess.__aenter__()
         return self
 
-    @property
-    def __aexit__(self):
-        return self._sess.__aexit__
+    async def __aexit__(self, *exc):
+        if self._owner:
+            await self._sess.__aexit__(*exc)
 
     async def auth(self, client_id, client_secret, redirect_uri, code):
         data = await self("POST", "/oauth2/token",
@@ -139,7 +189,12 @@ class MonzoAPI:
                           params={"account_id": account_id,
                                   "expand[]": "merchant",
                                   "since": since or ""})
-        return [item for item in data if not item["created"] == since]
+        items = [item for item in data if not item["created"] == since]
+        for item in items:
+            # Resolve the display name once here, rather than on every dashboard render.
+            party = item["merchant"] or item["counterparty"]
+            item["_merchant"] = party["name"] if party else None
+        return items
 
 
 def session(fn):